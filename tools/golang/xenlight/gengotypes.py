@@ -3,6 +3,12 @@
 import os
 import sys
 
+try:
+    # Python 2's io.StringIO only accepts unicode, not str.
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 try:
     sys.path.append(os.environ['LIBXL_SRC_DIR'])
 except:
@@ -26,14 +32,48 @@ builtin_type_names = {
 }
 
 # Some go keywords that conflict with field names in libxl structs.
-go_keywords = ['type', 'func']
+go_keywords = frozenset(['type', 'func'])
+
+go_builtin_types = frozenset(['bool', 'string', 'int', 'byte',
+                              'uint16', 'uint32', 'uint64'])
+
+# C types with the same memory layout as their Go counterparts, so
+# that arrays of them can be copied as a block.
+go_copyable_ctypes = frozenset(['uint8_t', 'uint16_t', 'uint32_t', 'uint64_t'])
+
+# Fixed start of helpers.gen.go, up to the cgo union typedefs,
+# and the end of the cgo preamble that follows them.
+helpers_header = ('package xenlight\n\n'
+                  'import (\n"unsafe"\n"errors"\n"fmt"\n)\n'
+                  '/*\n'
+                  '#cgo LDFLAGS: -lxenlight\n'
+                  '#include <stdlib.h>\n'
+                  '#include <libxl.h>\n'
+                  '\n')
+helpers_cgo_footer = '*/\nimport "C"\n'
+
+def xenlight_golang_memoize(fn):
+    """
+    Return a version of fn that remembers its result for
+    each set of arguments it is called with, in a plain dict.
+    """
+    cache = {}
+
+    def memoized(*args, **kwargs):
+        # Most calls pass no keyword arguments, so key those on
+        # args alone rather than building and sorting a kwargs key.
+        if kwargs:
+            key = (args, tuple(sorted(kwargs.items())))
+        else:
+            key = args
 
-go_builtin_types = ['bool', 'string', 'int', 'byte',
-                    'uint16', 'uint32', 'uint64']
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = fn(*args, **kwargs)
+            return result
 
-# cgo preamble for xenlight_helpers.go, created during type generation and
-# written later.
-cgo_helpers_preamble = []
+    return memoized
 
 def xenlight_golang_generate_types(path = None, types = None, comment = None):
     """
@@ -43,21 +83,26 @@ def xenlight_golang_generate_types(path = None, types = None, comment = None):
     if path is None:
         path = 'types.gen.go'
 
-    with open(path, 'w') as f:
-        if comment is not None:
-            f.write(comment)
-        f.write('package xenlight\n\n')
+    # Build the whole file in memory and write it out in one go.
+    f = StringIO()
 
-        for ty in types:
-            (tdef, extras) = xenlight_golang_type_define(ty)
+    if comment is not None:
+        f.write(comment)
+    f.write('package xenlight\n\n')
 
-            f.write(tdef)
+    for ty in types:
+        (tdef, extras) = xenlight_golang_type_define(ty)
+
+        f.write(tdef)
+        f.write('\n')
+
+        # Append extra types
+        for extra in extras:
+            f.write(extra)
             f.write('\n')
 
-            # Append extra types
-            for extra in extras:
-                f.write(extra)
-                f.write('\n')
+    with open(path, 'w') as out:
+        out.write(f.getvalue())
 
 def xenlight_golang_type_define(ty = None):
     """
@@ -74,31 +119,73 @@ def xenlight_golang_type_define(ty = None):
     elif isinstance(ty, idl.Aggregate):
         return xenlight_golang_define_struct(ty)
 
+@xenlight_golang_memoize
+def xenlight_golang_fields(ty = None):
+    """
+    Classify the fields of the aggregate type ty.
+
+    Return a tuple of (kind, field) pairs, where kind is
+    one of 'scalar', 'array', 'struct' (an anonymous nested
+    struct) or 'union' (a KeyedUnion). The type definition
+    and the fromC/toC emitters all walk this same list, so
+    each field is only inspected once.
+    """
+    fields = []
+
+    for f in ty.fields:
+        if f.type.typename is not None:
+            if isinstance(f.type, idl.Array):
+                fields.append(('array', f))
+            else:
+                fields.append(('scalar', f))
+
+        elif isinstance(f.type, idl.Struct):
+            fields.append(('struct', f))
+
+        elif isinstance(f.type, idl.KeyedUnion):
+            fields.append(('union', f))
+
+        else:
+            raise Exception('type {0} not supported'.format(f.type))
+
+    return tuple(fields)
+
 def xenlight_golang_define_enum(ty = None):
-    s = ''
+    parts = []
     typename = ''
 
     if ty.typename is not None:
         typename = xenlight_golang_fmt_name(ty.typename)
-        s += 'type {0} int\n'.format(typename)
+        parts.append('type {0} int\n'.format(typename))
 
     # Start const block
-    s += 'const(\n'
+    parts.append('const(\n')
 
     for v in ty.values:
         name = xenlight_golang_fmt_name(v.name)
-        s += '{0} {1} = {2}\n'.format(name, typename, v.value)
+        parts.append('{0} {1} = {2}\n'.format(name, typename, v.value))
 
     # End const block
-    s += ')\n'
+    parts.append(')\n')
 
-    return s
+    return ''.join(parts)
 
-def xenlight_golang_define_struct(ty = None, typename = None, nested = False):
-    s = ''
-    extras = []
+def xenlight_golang_define_struct(ty = None, typename = None, nested = False,
+                                  extras = None):
+    """
+    Generate the Go definition of the struct ty.
+
+    Return a tuple that contains a string with the struct
+    definition, and the list of extra definitions that are
+    associated with it. If extras is given, extra definitions
+    are appended to it rather than to a new list.
+    """
+    parts = []
     name = ''
 
+    if extras is None:
+        extras = []
+
     if typename is not None:
         name = xenlight_golang_fmt_name(typename)
     else:
@@ -106,47 +193,45 @@ def xenlight_golang_define_struct(ty = None, typename = None, nested = False):
 
     # Begin struct definition
     if nested:
-        s += '{0} struct {{\n'.format(name)
+        parts.append('{0} struct {{\n'.format(name))
     else:
-        s += 'type {0} struct {{\n'.format(name)
+        parts.append('type {0} struct {{\n'.format(name))
 
     # Write struct fields
-    for f in ty.fields:
-        if f.type.typename is not None:
-            if isinstance(f.type, idl.Array):
-                typename = f.type.elem_type.typename
-                typename = xenlight_golang_fmt_name(typename)
-                name     = xenlight_golang_fmt_name(f.name)
+    for (kind, f) in xenlight_golang_fields(ty):
+        if kind == 'array':
+            typename = f.type.elem_type.typename
+            typename = xenlight_golang_fmt_name(typename)
+            name     = xenlight_golang_fmt_name(f.name)
 
-                s += '{0} []{1}\n'.format(name, typename)
-            else:
-                typename = f.type.typename
-                typename = xenlight_golang_fmt_name(typename)
-                name     = xenlight_golang_fmt_name(f.name)
+            parts.append('{0} []{1}\n'.format(name, typename))
 
-                s += '{0} {1}\n'.format(name, typename)
+        elif kind == 'scalar':
+            typename = f.type.typename
+            typename = xenlight_golang_fmt_name(typename)
+            name     = xenlight_golang_fmt_name(f.name)
 
-        elif isinstance(f.type, idl.Struct):
-            r = xenlight_golang_define_struct(f.type, typename=f.name, nested=True)
+            parts.append('{0} {1}\n'.format(name, typename))
 
-            s += r[0]
-            extras.extend(r[1])
+        elif kind == 'struct':
+            r = xenlight_golang_define_struct(f.type, typename=f.name, nested=True,
+                                              extras=extras)
 
-        elif isinstance(f.type, idl.KeyedUnion):
-            r = xenlight_golang_define_union(f.type, ty.typename, f.name)
+            parts.append(r[0])
 
-            s += r[0]
-            extras.extend(r[1])
+        elif kind == 'union':
+            r = xenlight_golang_define_union(f.type, ty.typename, f.name,
+                                             extras=extras)
 
-        else:
-            raise Exception('type {0} not supported'.format(f.type))
+            parts.append(r[0])
 
     # End struct definition
-    s += '}\n'
+    parts.append('}\n')
 
-    return (s,extras)
+    return (''.join(parts),extras)
 
-def xenlight_golang_define_union(ty = None, struct_name = '', union_name = ''):
+def xenlight_golang_define_union(ty = None, struct_name = '', union_name = '',
+                                 extras = None):
     """
     Generate the Go translation of a KeyedUnion.
 
@@ -155,15 +240,13 @@ def xenlight_golang_define_union(ty = None, struct_name = '', union_name = ''):
     for each field of the union which implements
     that interface.
     """
-    s = ''
-    extras = []
+    if extras is None:
+        extras = []
 
     interface_name = '{0}_{1}_union'.format(struct_name, ty.keyvar.name)
     interface_name = xenlight_golang_fmt_name(interface_name, exported=False)
 
-    s += 'type {0} interface {{\n'.format(interface_name)
-    s += 'is{0}()\n'.format(interface_name)
-    s += '}\n'
+    s = 'type {0} interface {{\nis{0}()\n}}\n'.format(interface_name)
 
     extras.append(s)
 
@@ -171,116 +254,152 @@ def xenlight_golang_define_union(ty = None, struct_name = '', union_name = ''):
         if f.type is None:
             continue
 
-        # Define struct
+        # Define struct. Reserve its slot first, so that it comes
+        # before any extra definitions it adds itself.
         name = '{0}_{1}_union_{2}'.format(struct_name, ty.keyvar.name, f.name)
-        r = xenlight_golang_define_struct(f.type, typename=name)
-        extras.append(r[0])
-        extras.extend(r[1])
-
-        # This typeof trick ensures that the fields used in the cgo struct
-        # used for marshaling are the same as the fields of the union in the
-        # actual C type, and avoids re-defining all of those fields.
-        s = 'typedef typeof(((struct {0} *)NULL)->{1}.{2}){3};'
-        s = s.format(struct_name, union_name, f.name, name)
-        cgo_helpers_preamble.append(s)
+        slot = len(extras)
+        extras.append(None)
+        r = xenlight_golang_define_struct(f.type, typename=name, extras=extras)
+        extras[slot] = r[0]
 
         # Define function to implement 'union' interface
         name = xenlight_golang_fmt_name(name)
         s = 'func (x {0}) is{1}(){{}}\n'.format(name, interface_name)
         extras.append(s)
 
+    parts = []
+
     fname = xenlight_golang_fmt_name(ty.keyvar.name)
     ftype = xenlight_golang_fmt_name(ty.keyvar.type.typename)
-    s = '{0} {1}\n'.format(fname, ftype)
+    parts.append('{0} {1}\n'.format(fname, ftype))
 
     fname = xenlight_golang_fmt_name('{0}_union'.format(ty.keyvar.name))
-    s += '{0} {1}\n'.format(fname, interface_name)
+    parts.append('{0} {1}\n'.format(fname, interface_name))
 
-    return (s,extras)
+    return (''.join(parts),extras)
 
-def xenlight_golang_generate_helpers(path = None, types = None, comment = None):
+def xenlight_golang_generate_helpers(path = None, structs = None, comment = None):
     """
     Generate a .go file (helpers.gen.go by default)
     that contains helper functions for marshaling between
-    C and Go types.
+    C and Go types, for each struct type in structs.
     """
     if path is None:
         path = 'helpers.gen.go'
 
-    with open(path, 'w') as f:
-        if comment is not None:
-            f.write(comment)
-        f.write('package xenlight\n\n')
-        f.write('import (\n"unsafe"\n"errors"\n"fmt"\n)\n')
-
-        # Cgo preamble
-        f.write('/*\n')
-        f.write('#cgo LDFLAGS: -lxenlight\n')
-        f.write('#include <stdlib.h>\n')
-        f.write('#include <libxl.h>\n')
+    # Build the whole file in memory and write it out in one go.
+    f = StringIO()
+
+    if comment is not None:
+        f.write(comment)
+    f.write(helpers_header)
+    f.write(xenlight_golang_cgo_preamble(structs))
+    f.write(helpers_cgo_footer)
+
+    for ty in structs:
+        xenlight_golang_define_constructor(ty, f)
         f.write('\n')
 
-        for s in cgo_helpers_preamble:
-            f.write(s)
-            f.write('\n')
+        xenlight_golang_define_marshaling(ty, f)
+        f.write('\n')
 
-        f.write('*/\nimport "C"\n')
+    with open(path, 'w') as out:
+        out.write(f.getvalue())
 
-        for ty in types:
-            if not isinstance(ty, idl.Struct):
-                continue
+def xenlight_golang_cgo_preamble(structs = None):
+    """
+    Return the variable part of the cgo preamble for
+    helpers.gen.go: a C typedef for each keyed union member
+    struct found in structs, emitted once per name.
+    """
+    typedefs = []
+    seen = set()
 
-            f.write(xenlight_golang_define_constructor(ty))
-            f.write('\n')
+    def walk(ty):
+        for (kind, f) in xenlight_golang_fields(ty):
+            if kind == 'struct':
+                walk(f.type)
 
-            (fdef, extras) = xenlight_golang_define_from_C(ty)
+            elif kind == 'union':
+                for uf in f.type.fields:
+                    if uf.type is None:
+                        continue
 
-            f.write(fdef)
-            f.write('\n')
+                    name = '{0}_{1}_union_{2}'.format(
+                        ty.typename, f.type.keyvar.name, uf.name)
+                    if name in seen:
+                        continue
+                    seen.add(name)
 
-            for extra in extras:
-                f.write(extra)
-                f.write('\n')
+                    walk(uf.type)
 
-            f.write(xenlight_golang_define_to_C(ty))
-            f.write('\n')
+                    # This typeof trick ensures that the fields used in the
+                    # cgo struct used for marshaling are the same as the
+                    # fields of the union in the actual C type, and avoids
+                    # re-defining all of those fields.
+                    typedefs.append('typedef typeof(((struct {0} *)NULL)'
+                                    '->{1}.{2}){3};\n'.format(
+                                        ty.typename, f.name, uf.name, name))
 
-def xenlight_golang_define_from_C(ty = None):
-    """
-    Define the fromC marshaling function for the type
-    represented by ty.
+    for ty in structs:
+        walk(ty)
+
+    return ''.join(typedefs)
+
+def xenlight_golang_define_marshaling(ty = None, out = None):
     """
-    func = 'func (x *{0}) fromC(xc *C.{1}) error {{\n {2}\n return nil}}\n'
+    Define the fromC and toC marshaling functions for the type
+    represented by ty, and write them to out, with any extra
+    definitions needed by fromC in between.
 
+    Both functions come from one walk over the fields of ty.
+    The toC body is held back until fromC and its extras
+    have been written.
+    """
     goname = xenlight_golang_fmt_name(ty.typename)
     cname  = ty.typename
 
-    body = ''
     extras = []
+    to_C = []
 
-    for f in ty.fields:
-        if f.type.typename is not None:
-            if isinstance(f.type, idl.Array):
-                body += xenlight_golang_array_from_C(f)
-                continue
+    out.write('func (x *{0}) fromC(xc *C.{1}) error {{\n '.format(goname, cname))
 
-            body += xenlight_golang_convert_from_C(f)
+    if ty.dispose_fn is not None:
+        to_C.append('defer func(){{\nif err != nil{{\nC.{0}(xc)}}\n}}()\n\n'.format(
+            ty.dispose_fn))
 
-        elif isinstance(f.type, idl.Struct):
+    for (kind, f) in xenlight_golang_fields(ty):
+        if kind == 'array':
+            out.write(xenlight_golang_array_from_C(f))
+            to_C.append(xenlight_golang_array_to_C(f))
+
+        elif kind == 'scalar':
+            out.write(xenlight_golang_convert_from_C(f))
+            to_C.append(xenlight_golang_convert_to_C(f))
+
+        elif kind == 'struct':
             # Go through the fields of the anonymous nested struct.
             for nf in f.type.fields:
-                body += xenlight_golang_convert_from_C(nf,outer_name=f.name)
+                out.write(xenlight_golang_convert_from_C(nf,outer_name=f.name))
+                to_C.append(xenlight_golang_convert_to_C(nf, outer_name=f.name))
 
-        elif isinstance(f.type, idl.KeyedUnion):
-            r = xenlight_golang_union_from_C(f.type, f.name, ty.typename)
+        elif kind == 'union':
+            r = xenlight_golang_union_from_C(f.type, f.name, ty.typename,
+                                             extras=extras)
 
-            body += r[0]
-            extras.extend(r[1])
+            out.write(r[0])
+            to_C.append(xenlight_golang_union_to_C(f.type, f.name, ty.typename))
 
-        else:
-            raise Exception('type {0} not supported'.format(f.type))
+    out.write('\n return nil}\n')
+    out.write('\n')
+
+    for extra in extras:
+        out.write(extra)
+        out.write('\n')
 
-    return (func.format(goname, cname, body), extras)
+    out.write('func (x *{0}) toC(xc *C.{1}) (err error){{'.format(goname, cname))
+    out.writelines(to_C)
+    out.write('\n return nil\n }\n')
 
 def xenlight_golang_convert_from_C(ty = None, outer_name = None, cvarname = None):
     """
@@ -290,12 +409,40 @@ def xenlight_golang_convert_from_C(ty = None, outer_name = None, cvarname = None
     If outer_name is set, the type is treated as nested within another field
     named outer_name.
     """
-    s = ''
-
     # Use 'xc' as the name for the C variable unless otherwise specified
     if cvarname is None:
         cvarname = 'xc'
 
+    (gotypename, goname, _, cname, is_castable) = xenlight_golang_field_info(ty, outer_name)
+
+    if not is_castable:
+        # If the type is not castable, we need to call its fromC
+        # function.
+        return ('if err := x.{0}.fromC(&{1}.{2});'
+                'err != nil {{\nreturn fmt.Errorf("converting field {0}: %v", err)\n}}\n'.format(
+                    goname, cvarname, cname))
+
+    elif gotypename == 'string':
+        # Use the cgo helper for converting C strings.
+        return 'x.{0} = C.GoString({1}.{2})\n'.format(goname, cvarname, cname)
+
+    return 'x.{0} = {1}({2}.{3})\n'.format(goname, gotypename, cvarname, cname)
+
+@xenlight_golang_memoize
+def xenlight_golang_field_info(ty = None, outer_name = None):
+    """
+    Return a tuple (gotypename, goname, ctypename, cname, is_castable)
+    describing the field represented by ty, for use by both
+    the fromC and toC marshaling code.
+
+    gotypename and goname are the Go type and field names, and
+    ctypename is the C type name of the field. cname is the name
+    used to access the field through cgo, and is_castable is True if the field can be converted
+    with a simple cast rather than a fromC/toC call.
+
+    If outer_name is set, the names are qualified as nested
+    within another field named outer_name.
+    """
     gotypename = xenlight_golang_fmt_name(ty.type.typename)
     goname     = xenlight_golang_fmt_name(ty.name)
     cname      = ty.name
@@ -316,23 +463,12 @@ def xenlight_golang_convert_from_C(ty = None, outer_name = None, cvarname = None
                    isinstance(ty.type, idl.Enumeration) or
                    gotypename in go_builtin_types)
 
-    if not is_castable:
-        # If the type is not castable, we need to call its fromC
-        # function.
-        s += 'if err := x.{0}.fromC(&{1}.{2});'.format(goname,cvarname,cname)
-        s += 'err != nil {{\nreturn fmt.Errorf("converting field {0}: %v", err)\n}}\n'.format(goname)
+    return (gotypename, goname, ty.type.typename, cname, is_castable)
 
-    elif gotypename == 'string':
-        # Use the cgo helper for converting C strings.
-        s += 'x.{0} = C.GoString({1}.{2})\n'.format(goname,cvarname,cname)
-
-    else:
-        s += 'x.{0} = {1}({2}.{3})\n'.format(goname,gotypename,cvarname,cname)
-
-    return s
-
-def xenlight_golang_union_from_C(ty = None, union_name = '', struct_name = ''):
-    extras = []
+def xenlight_golang_union_from_C(ty = None, union_name = '', struct_name = '',
+                                 extras = None):
+    if extras is None:
+        extras = []
 
     keyname   = ty.keyvar.name
     gokeyname = xenlight_golang_fmt_name(keyname)
@@ -340,79 +476,73 @@ def xenlight_golang_union_from_C(ty = None, union_name = '', struct_name = ''):
     gokeytype = xenlight_golang_fmt_name(keytype)
     field_name = xenlight_golang_fmt_name('{0}_union'.format(keyname))
 
-    interface_name = '{0}_{1}_union'.format(struct_name, keyname)
-    interface_name = xenlight_golang_fmt_name(interface_name, exported=False)
-
     cgo_keyname = keyname
     if cgo_keyname in go_keywords:
         cgo_keyname = '_' + cgo_keyname
 
-    cases = {}
+    cases = []
 
     for f in ty.fields:
         val = '{0}_{1}'.format(keytype, f.name)
         val = xenlight_golang_fmt_name(val)
 
-        # Add to list of cases to make for the switch
-        # statement below.
-        cases[f.name] = (val, f.type)
-
         if f.type is None:
+            # Add to list of cases to make for the switch
+            # statement below.
+            cases.append((f.name, (val, None)))
             continue
 
         # Define fromC func for 'union' struct.
-        typename   = '{0}_{1}_union_{2}'.format(struct_name,keyname,f.name)
+        typename   = '{0}_{1}_union_{2}'.format(struct_name, keyname, f.name)
         gotypename = xenlight_golang_fmt_name(typename)
 
+        cases.append((f.name, (val, gotypename)))
+
         # Define the function here. The cases for keyed unions are a little
         # different.
-        s = 'func (x *{0}) fromC(xc *C.{1}) error {{\n'.format(gotypename,struct_name)
-        s += 'if {0}(xc.{1}) != {2} {{\n'.format(gokeytype,cgo_keyname,val)
-        err_string = '"expected union key {0}"'.format(val)
-        s += 'return errors.New({0})\n'.format(err_string)
-        s += '}\n\n'
-        s += 'tmp := (*C.{0})(unsafe.Pointer(&xc.{1}[0]))\n'.format(typename,union_name)
+        parts = ['func (x *{0}) fromC(xc *C.{1}) error {{\n'
+                 'if {2}(xc.{3}) != {4} {{\n'
+                 'return errors.New("expected union key {4}")\n'
+                 '}}\n\n'
+                 'tmp := (*C.{5})(unsafe.Pointer(&xc.{6}[0]))\n'.format(
+                     gotypename, struct_name, gokeytype, cgo_keyname, val,
+                     typename, union_name)]
 
         for nf in f.type.fields:
-            s += xenlight_golang_convert_from_C(nf,cvarname='tmp')
+            parts.append(xenlight_golang_convert_from_C(nf,cvarname='tmp'))
 
-        s += 'return nil\n'
-        s += '}\n'
+        parts.append('return nil\n}\n')
 
-        extras.append(s)
+        extras.append(''.join(parts))
 
-    s = 'x.{0} = {1}(xc.{2})\n'.format(gokeyname,gokeytype,cgo_keyname)
-    s += 'switch x.{0}{{\n'.format(gokeyname)
+    parts = ['x.{0} = {1}(xc.{2})\n'
+             'switch x.{0}{{\n'.format(gokeyname, gokeytype, cgo_keyname)]
 
     # Create switch statement to determine which 'union element'
     # to populate in the Go struct.
-    for case_name, case_tuple in sorted(cases.items()):
-        (case_val, case_type) = case_tuple
-
-        s += 'case {0}:\n'.format(case_val)
+    for case_name, case_tuple in sorted(cases):
+        (case_val, gotype) = case_tuple
 
-        if case_type is None:
-            s += "x.{0} = nil\n".format(field_name)
+        if gotype is None:
+            parts.append('case {0}:\n'
+                         'x.{1} = nil\n'.format(case_val, field_name))
             continue
 
-        gotype = '{0}_{1}_union_{2}'.format(struct_name,keyname,case_name)
-        gotype = xenlight_golang_fmt_name(gotype)
-        goname = '{0}_{1}'.format(keyname,case_name)
+        goname = '{0}_{1}'.format(keyname, case_name)
         goname = xenlight_golang_fmt_name(goname,exported=False)
 
-        s += 'var {0} {1}\n'.format(goname, gotype)
-        s += 'if err := {0}.fromC(xc);'.format(goname)
-        s += 'err != nil {{\n return fmt.Errorf("converting field {0}: %v", err)\n}}\n'.format(goname)
-
-        s += 'x.{0} = {1}\n'.format(field_name, goname)
+        parts.append('case {0}:\n'
+                     'var {1} {2}\n'
+                     'if err := {1}.fromC(xc);'
+                     'err != nil {{\n return fmt.Errorf("converting field {1}: %v", err)\n}}\n'
+                     'x.{3} = {1}\n'.format(case_val, goname, gotype, field_name))
 
     # End switch statement
-    s += 'default:\n'
-    err_string = '"invalid union key \'%v\'", x.{0}'.format(gokeyname)
-    s += 'return fmt.Errorf({0})'.format(err_string)
-    s += '}\n'
+    parts.append('default:\n'
+                 'return fmt.Errorf("invalid union key \'%v\'", x.{0})'
+                 '}}\n'.format(gokeyname))
 
-    return (s,extras)
+    return (''.join(parts),extras)
 
 def xenlight_golang_array_from_C(ty = None):
     """
@@ -421,8 +551,6 @@ def xenlight_golang_array_from_C(ty = None):
 
     https://github.com/golang/go/wiki/cgo#turning-c-arrays-into-go-slices
     """
-    s = ''
-
     gotypename = xenlight_golang_fmt_name(ty.type.elem_type.typename)
     goname     = xenlight_golang_fmt_name(ty.name)
     ctypename  = ty.type.elem_type.typename
@@ -430,57 +558,37 @@ def xenlight_golang_array_from_C(ty = None):
     cslice     = 'c{0}'.format(goname)
     clenvar    = ty.type.lenvar.name
 
-    s += 'x.{0} = nil\n'.format(goname)
-    s += 'if n := int(xc.{0}); n > 0 {{\n'.format(clenvar)
-    s += '{0} := '.format(cslice)
-    s +='(*[1<<28]C.{0})(unsafe.Pointer(xc.{1}))[:n:n]\n'.format(ctypename, cname)
-    s += 'x.{0} = make([]{1}, n)\n'.format(goname, gotypename)
-    s += 'for i, v := range {0} {{\n'.format(cslice)
+    # Arrays of fixed-width integers need no per-element conversion.
+    if ctypename in go_copyable_ctypes:
+        if gotypename == 'byte':
+            body = 'x.{0} = C.GoBytes(unsafe.Pointer(xc.{1}), C.int(n))\n'.format(
+                goname, cname)
+        else:
+            body = ('x.{0} = make([]{1}, n)\n'
+                    'copy(x.{0}, (*[1<<28]{1})(unsafe.Pointer(xc.{2}))[:n:n])\n'.format(
+                        goname, gotypename, cname))
+
+        return ('x.{0} = nil\n'
+                'if n := int(xc.{1}); n > 0 {{\n'
+                '{2}'
+                '}}\n'.format(goname, clenvar, body))
 
     is_enum = isinstance(ty.type.elem_type,idl.Enumeration)
     if gotypename in go_builtin_types or is_enum:
-        s += 'x.{0}[i] = {1}(v)\n'.format(goname, gotypename)
+        convert = 'x.{0}[i] = {1}(v)\n'.format(goname, gotypename)
     else:
-        s += 'if err := x.{0}[i].fromC(&v); err != nil {{\n'.format(goname)
-        s += 'return fmt.Errorf("converting field {0}: %v", err) }}\n'.format(goname)
-
-    s += '}\n}\n'
-
-    return s
-
-def xenlight_golang_define_to_C(ty = None, typename = None, nested = False):
-    """
-    Define the toC marshaling function for the type
-    represented by ty.
-    """
-    func = 'func (x *{0}) toC(xc *C.{1}) (err error){{{2}\n return nil\n }}\n'
-    body = ''
-
-    if ty.dispose_fn is not None:
-        body += 'defer func(){{\nif err != nil{{\nC.{0}(xc)}}\n}}()\n\n'.format(ty.dispose_fn)
-
-    goname = xenlight_golang_fmt_name(ty.typename)
-    cname  = ty.typename
-
-    for f in ty.fields:
-        if f.type.typename is not None:
-            if isinstance(f.type, idl.Array):
-                body += xenlight_golang_array_to_C(f)
-                continue
-
-            body += xenlight_golang_convert_to_C(f)
-
-        elif isinstance(f.type, idl.Struct):
-            for nf in f.type.fields:
-                body += xenlight_golang_convert_to_C(nf, outer_name=f.name)
-
-        elif isinstance(f.type, idl.KeyedUnion):
-            body += xenlight_golang_union_to_C(f.type, f.name, ty.typename)
-
-        else:
-            raise Exception('type {0} not supported'.format(f.type))
-
-    return func.format(goname, cname, body)
+        convert = ('if err := x.{0}[i].fromC(&v); err != nil {{\n'
+                   'return fmt.Errorf("converting field {0}: %v", err) }}\n'.format(
+                       goname))
+
+    return ('x.{0} = nil\n'
+            'if n := int(xc.{1}); n > 0 {{\n'
+            '{2} := (*[1<<28]C.{3})(unsafe.Pointer(xc.{4}))[:n:n]\n'
+            'x.{0} = make([]{5}, n)\n'
+            'for i, v := range {2} {{\n'
+            '{6}'
+            '}}\n}}\n'.format(
+                goname, clenvar, cslice, ctypename, cname, gotypename, convert))
 
 def xenlight_golang_convert_to_C(ty = None, outer_name = None,
                                  govarname = None, cvarname = None):
@@ -491,8 +599,6 @@ def xenlight_golang_convert_to_C(ty = None, outer_name = None,
     If outer_name is set, the type is treated as nested within another field
     named outer_name.
     """
-    s = ''
-
     # Use 'xc' as the name for the C variable unless otherwise specified.
     if cvarname is None:
         cvarname = 'xc'
@@ -501,41 +607,22 @@ def xenlight_golang_convert_to_C(ty = None, outer_name = None,
     if govarname is None:
         govarname = 'x'
 
-    gotypename = xenlight_golang_fmt_name(ty.type.typename)
-    ctypename  = ty.type.typename
-    goname     = xenlight_golang_fmt_name(ty.name)
-    cname      = ty.name
-
-    # In cgo, C names that conflict with Go keywords can be
-    # accessed by prepending an underscore to the name.
-    if cname in go_keywords:
-        cname = '_' + cname
-
-    # If outer_name is set, treat this as nested.
-    if outer_name is not None:
-        goname = '{0}.{1}'.format(xenlight_golang_fmt_name(outer_name), goname)
-        cname  = '{0}.{1}'.format(outer_name, cname)
-
-    is_castable = (ty.type.json_parse_type == 'JSON_INTEGER' or
-                   isinstance(ty.type, idl.Enumeration) or
-                   gotypename in go_builtin_types)
+    (gotypename, goname, ctypename, cname, is_castable) = \
+        xenlight_golang_field_info(ty, outer_name)
 
     if not is_castable:
-        s += 'if err := {0}.{1}.toC(&{2}.{3}); err != nil {{\n'.format(govarname,goname,
-                                                                   cvarname,cname)
-        s += 'return fmt.Errorf("converting field {0}: %v", err)\n}}\n'.format(goname)
+        return ('if err := {0}.{1}.toC(&{2}.{3}); err != nil {{\n'
+                'return fmt.Errorf("converting field {1}: %v", err)\n}}\n'.format(
+                    govarname, goname, cvarname, cname))
 
     elif gotypename == 'string':
         # Use the cgo helper for converting C strings.
-        s += 'if {0}.{1} != "" {{\n'.format(govarname,goname)
-        s += '{0}.{1} = C.CString({2}.{3})}}\n'.format(cvarname,cname,
-                                                   govarname,goname)
+        return ('if {0}.{1} != "" {{\n'
+                '{2}.{3} = C.CString({0}.{1})}}\n'.format(
+                    govarname, goname, cvarname, cname))
 
-    else:
-        s += '{0}.{1} = C.{2}({3}.{4})\n'.format(cvarname,cname,ctypename,
-                                            govarname,goname)
-
-    return s
+    return '{0}.{1} = C.{2}({3}.{4})\n'.format(
+        cvarname, cname, ctypename, govarname, goname)
 
 def xenlight_golang_union_to_C(ty = None, union_name = '',
                                struct_name = ''):
@@ -543,60 +630,51 @@ def xenlight_golang_union_to_C(ty = None, union_name = '',
     gokeyname = xenlight_golang_fmt_name(keyname)
     keytype   = ty.keyvar.type.typename
     gokeytype = xenlight_golang_fmt_name(keytype)
-
-    interface_name = '{0}_{1}_union'.format(struct_name, keyname)
-    interface_name = xenlight_golang_fmt_name(interface_name, exported=False)
+    field_name = xenlight_golang_fmt_name('{0}_union'.format(keyname))
 
     cgo_keyname = keyname
     if cgo_keyname in go_keywords:
         cgo_keyname = '_' + cgo_keyname
 
-
-    s = 'xc.{0} = C.{1}(x.{2})\n'.format(cgo_keyname,keytype,gokeyname)
-    s += 'switch x.{0}{{\n'.format(gokeyname)
+    parts = ['xc.{0} = C.{1}(x.{2})\n'
+             'switch x.{2}{{\n'.format(cgo_keyname, keytype, gokeyname)]
 
     # Create switch statement to determine how to populate the C union.
     for f in ty.fields:
         key_val = '{0}_{1}'.format(keytype, f.name)
         key_val = xenlight_golang_fmt_name(key_val)
 
-        s += 'case {0}:\n'.format(key_val)
-
         if f.type is None:
-            s += "break\n"
+            parts.append('case {0}:\n'
+                         'break\n'.format(key_val))
             continue
 
-        cgotype = '{0}_{1}_union_{2}'.format(struct_name,keyname,f.name)
+        cgotype = '{0}_{1}_union_{2}'.format(struct_name, keyname, f.name)
         gotype  = xenlight_golang_fmt_name(cgotype)
 
-        field_name = xenlight_golang_fmt_name('{0}_union'.format(keyname))
-        s += 'tmp, ok := x.{0}.({1})\n'.format(field_name,gotype)
-        s += 'if !ok {\n'
-        s += 'return errors.New("wrong type for union key {0}")\n'.format(keyname)
-        s += '}\n'
-
-        s += 'var {0} C.{1}\n'.format(f.name,cgotype)
+        parts.append('case {0}:\n'
+                     'tmp, ok := x.{1}.({2})\n'
+                     'if !ok {{\n'
+                     'return errors.New("wrong type for union key {3}")\n'
+                     '}}\n'
+                     'var {4} C.{5}\n'.format(
+                         key_val, field_name, gotype, keyname, f.name, cgotype))
         for uf in f.type.fields:
-            s += xenlight_golang_convert_to_C(uf,cvarname=f.name,
-                                              govarname='tmp')
+            parts.append(xenlight_golang_convert_to_C(uf,cvarname=f.name,
+                                                      govarname='tmp'))
 
         # The union is still represented as Go []byte.
-        s += '{0}Bytes := C.GoBytes(unsafe.Pointer(&{1}),C.sizeof_{2})\n'.format(f.name,
-                                                                              f.name,
-                                                                              cgotype)
-        s += 'copy(xc.{0}[:],{1}Bytes)\n'.format(union_name,f.name)
+        parts.append('{0}Bytes := C.GoBytes(unsafe.Pointer(&{0}),C.sizeof_{1})\n'
+                     'copy(xc.{2}[:],{0}Bytes)\n'.format(f.name, cgotype, union_name))
 
     # End switch statement
-    s += 'default:\n'
-    err_string = '"invalid union key \'%v\'", x.{0}'.format(gokeyname)
-    s += 'return fmt.Errorf({0})'.format(err_string)
-    s += '}\n'
+    parts.append('default:\n'
+                 'return fmt.Errorf("invalid union key \'%v\'", x.{0})'
+                 '}}\n'.format(gokeyname))
 
-    return s
+    return ''.join(parts)
 
 def xenlight_golang_array_to_C(ty = None):
-    s = ''
-
     gotypename = xenlight_golang_fmt_name(ty.type.elem_type.typename)
     goname     = xenlight_golang_fmt_name(ty.name)
     ctypename  = ty.type.elem_type.typename
@@ -606,42 +684,34 @@ def xenlight_golang_array_to_C(ty = None):
 
     is_enum = isinstance(ty.type.elem_type,idl.Enumeration)
     if gotypename in go_builtin_types or is_enum:
-        s += 'if {0} := len(x.{1}); {2} > 0 {{\n'.format(golenvar,goname,golenvar)
-        s += 'xc.{0} = (*C.{1})(C.malloc(C.size_t({2}*{3})))\n'.format(cname,ctypename,
-                                                                   golenvar,golenvar)
-        s += 'xc.{0} = C.int({1})\n'.format(clenvar,golenvar)
-        s += 'c{0} := (*[1<<28]C.{1})(unsafe.Pointer(xc.{2}))[:{3}:{4}]\n'.format(goname,
-                                                                      ctypename,cname,
-                                                                      golenvar,golenvar)
-        s += 'for i,v := range x.{0} {{\n'.format(goname)
-        s += 'c{0}[i] = C.{1}(v)\n'.format(goname,ctypename)
-        s += '}\n}\n'
-
-        return s
-
-    s += 'if {0} := len(x.{1}); {2} > 0 {{\n'.format(golenvar,goname,golenvar)
-    s += 'xc.{0} = (*C.{1})(C.malloc(C.ulong({2})*C.sizeof_{3}))\n'.format(cname,ctypename,
-                                                                   golenvar,ctypename)
-    s += 'xc.{0} = C.int({1})\n'.format(clenvar,golenvar)
-    s += 'c{0} := (*[1<<28]C.{1})(unsafe.Pointer(xc.{2}))[:{3}:{4}]\n'.format(goname,
-                                                                         ctypename,cname,
-                                                                         golenvar,golenvar)
-    s += 'for i,v := range x.{0} {{\n'.format(goname)
-    s += 'if err := v.toC(&c{0}[i]); err != nil {{\n'.format(goname)
-    s += 'return fmt.Errorf("converting field {0}: %v", err)\n'.format(goname)
-    s += '}\n}\n}\n'
-
-    return s
-
-def xenlight_golang_define_constructor(ty = None):
-    s = ''
-
+        return ('if {0} := len(x.{1}); {0} > 0 {{\n'
+                'xc.{2} = (*C.{3})(C.malloc(C.size_t({0}*{0})))\n'
+                'xc.{4} = C.int({0})\n'
+                'c{1} := (*[1<<28]C.{3})(unsafe.Pointer(xc.{2}))[:{0}:{0}]\n'
+                'for i,v := range x.{1} {{\n'
+                'c{1}[i] = C.{3}(v)\n'
+                '}}\n}}\n'.format(golenvar, goname, cname, ctypename, clenvar))
+
+    return ('if {0} := len(x.{1}); {0} > 0 {{\n'
+            'xc.{2} = (*C.{3})(C.malloc(C.ulong({0})*C.sizeof_{3}))\n'
+            'xc.{4} = C.int({0})\n'
+            'c{1} := (*[1<<28]C.{3})(unsafe.Pointer(xc.{2}))[:{0}:{0}]\n'
+            'for i,v := range x.{1} {{\n'
+            'if err := v.toC(&c{1}[i]); err != nil {{\n'
+            'return fmt.Errorf("converting field {1}: %v", err)\n'
+            '}}\n}}\n}}\n'.format(golenvar, goname, cname, ctypename, clenvar))
+
+def xenlight_golang_define_constructor(ty = None, out = None):
+    """
+    Define the New<Type> constructor for the type
+    represented by ty, and write it to out.
+    """
     ctypename  = ty.typename
     gotypename = xenlight_golang_fmt_name(ctypename)
 
     # Since this func is exported, add a comment as per Go conventions.
-    s += '// New{0} returns an instance of {1}'.format(gotypename,gotypename)
-    s += ' initialized with defaults.\n'
+    out.write('// New{0} returns an instance of {0}'
+              ' initialized with defaults.\n'.format(gotypename))
 
     # If a struct has a keyed union, an extra argument is
     # required in the function signature, and an extra _init
@@ -652,8 +722,8 @@ def xenlight_golang_define_constructor(ty = None):
     # Add call to parent init_fn first.
     init_fns.append('C.{0}(&xc)'.format(ty.init_fn))
 
-    for f in ty.fields:
-        if not isinstance(f.type, idl.KeyedUnion):
+    for (kind, f) in xenlight_golang_fields(ty):
+        if kind != 'union':
             continue
 
         param = f.type.keyvar
@@ -668,55 +738,63 @@ def xenlight_golang_define_constructor(ty = None):
             param_goname = '{0}type'.format(param_gotype.lower()[0])
 
         # Add call to keyed union's init_fn.
-        init_fns.append('C.{0}_{1}(&xc, C.{2}({3}))'.format(ty.init_fn,
-                                                        param.name,
-                                                        param_ctype,
-                                                        param_goname))
+        init_fns.append('C.{0}_{1}(&xc, C.{2}({3}))'.format(
+            ty.init_fn, param.name, param_ctype, param_goname))
 
         # Add to params list.
         params.append('{0} {1}'.format(param_goname, param_gotype))
 
-    # Define function
-    s += 'func New{0}({1}) (*{2}, error) {{\n'.format(gotypename,
-                                                   ','.join(params),
-                                                   gotypename)
+    params   = ','.join(params)
+    init_fns = '\n'.join(init_fns)
 
-    # Declare variables.
-    s += 'var (\nx {0}\nxc C.{1})\n\n'.format(gotypename, ctypename)
-
-    # Write init_fn calls.
-    s += '\n'.join(init_fns)
-    s += '\n'
+    # Define function, declare variables and write init_fn calls.
+    out.write('func New{0}({1}) (*{0}, error) {{\n'
+              'var (\nx {0}\nxc C.{2})\n\n'
+              '{3}\n'.format(gotypename, params, ctypename, init_fns))
 
     # Make sure dispose_fn get's called when constructor
     # returns.
     if ty.dispose_fn is not None:
-        s += 'defer C.{0}(&xc)\n'.format(ty.dispose_fn)
-
-    s += '\n'
+        out.write('defer C.{0}(&xc)\n'.format(ty.dispose_fn))
 
     # Call fromC to initialize Go type.
-    s += 'if err := x.fromC(&xc); err != nil {\n'
-    s += 'return nil, err }\n\n'
-    s += 'return &x, nil}\n'
-
-    return s
+    out.write('\n'
+              'if err := x.fromC(&xc); err != nil {\n'
+              'return nil, err }\n\n'
+              'return &x, nil}\n')
 
+@xenlight_golang_memoize
 def xenlight_golang_fmt_name(name, exported = True):
     """
     Take a given type name and return an
     appropriate Go type name.
+
+    Results are cached, so builtin_type_names must not change
+    once generation has started.
     """
-    if name in builtin_type_names.keys():
+    if name in builtin_type_names:
         return builtin_type_names[name]
 
+    return xenlight_golang_fmt_words(name, exported)
+
+def xenlight_golang_fmt_words(name, exported = True):
+    """
+    Format name for Go, ignoring builtin_type_names.
+    """
+    # Single words need no splitting or joining.
+    if '_' not in name and name.lower() != 'libxl':
+        return name.title() if exported else name
+
     # Name is not a builtin, format it for Go.
     words = name.split('_')
 
     # Remove 'libxl' prefix
     if words[0].lower() == 'libxl':
-        words.remove(words[0])
+        del words[0]
 
+    # This has to stay str.title(), rather than just upper-casing the
+    # first letter: IDL words like 'p9s', 'altp2m' and 'S3RESUME' rely
+    # on its handling of digits and upper case letters.
     if exported:
         return ''.join(x.title() for x in words)
 
@@ -727,17 +805,22 @@ if __name__ == '__main__':
 
     (builtins, types) = idl.parse(idlname)
 
+    # Add the libxl-defined builtins. This has to be complete before the
+    # first call to xenlight_golang_fmt_name, which caches lookups in it.
+    # builtins also contains the idl builtins already mapped above; those
+    # keep their Go types.
     for b in builtins:
-        name = b.typename
-        builtin_type_names[name] = xenlight_golang_fmt_name(name)
+        if b.typename not in builtin_type_names:
+            builtin_type_names[b.typename] = xenlight_golang_fmt_words(b.typename)
 
-    header_comment="""// Code generated by {}. DO NOT EDIT.
-// source: {}
-
-""".format(os.path.basename(sys.argv[0]),
-           ' '.join([os.path.basename(a) for a in sys.argv[1:]]))
+    sources = ' '.join([os.path.basename(a) for a in sys.argv[1:]])
+    header_comment = ('// Code generated by {0}. DO NOT EDIT.\n'
+                      '// source: {1}\n\n'.format(os.path.basename(sys.argv[0]), sources))
 
     xenlight_golang_generate_types(types=types,
                                    comment=header_comment)
-    xenlight_golang_generate_helpers(types=types,
+    # Marshaling helpers are only generated for structs.
+    structs = [ty for ty in types if isinstance(ty, idl.Struct)]
+
+    xenlight_golang_generate_helpers(structs=structs,
                                      comment=header_comment)
@@ -869,11 +869,8 @@ func (x *VnodeInfo) fromC(xc *C.libxl_vnode_info) error {
  x.Memkb = uint64(xc.memkb)
 x.Distances = nil
 if n := int(xc.num_distances); n > 0 {
-cDistances := (*[1<<28]C.uint32_t)(unsafe.Pointer(xc.distances))[:n:n]
 x.Distances = make([]uint32, n)
-for i, v := range cDistances {
-x.Distances[i] = uint32(v)
-}
+copy(x.Distances, (*[1<<28]uint32)(unsafe.Pointer(xc.distances))[:n:n])
 }
 x.Pnode = uint32(xc.pnode)
 if err := x.Vcpus.fromC(&xc.vcpus);err != nil {
@@ -1046,11 +1043,8 @@ return fmt.Errorf("converting field Ioports: %v", err) }
 }
 x.Irqs = nil
 if n := int(xc.num_irqs); n > 0 {
-cIrqs := (*[1<<28]C.uint32_t)(unsafe.Pointer(xc.irqs))[:n:n]
 x.Irqs = make([]uint32, n)
-for i, v := range cIrqs {
-x.Irqs[i] = uint32(v)
-}
+copy(x.Irqs, (*[1<<28]uint32)(unsafe.Pointer(xc.irqs))[:n:n])
 }
 x.Iomem = nil
 if n := int(xc.num_iomem); n > 0 {
@@ -2521,11 +2515,8 @@ return &x, nil}
 func (x *VsndParams) fromC(xc *C.libxl_vsnd_params) error {
  x.SampleRates = nil
 if n := int(xc.num_sample_rates); n > 0 {
-cSampleRates := (*[1<<28]C.uint32_t)(unsafe.Pointer(xc.sample_rates))[:n:n]
 x.SampleRates = make([]uint32, n)
-for i, v := range cSampleRates {
-x.SampleRates[i] = uint32(v)
-}
+copy(x.SampleRates, (*[1<<28]uint32)(unsafe.Pointer(xc.sample_rates))[:n:n])
 }
 x.SampleFormats = nil
 if n := int(xc.num_sample_formats); n > 0 {
@@ -3684,11 +3675,8 @@ func (x *Numainfo) fromC(xc *C.libxl_numainfo) error {
 x.Free = uint64(xc.free)
 x.Dists = nil
 if n := int(xc.num_dists); n > 0 {
-cDists := (*[1<<28]C.uint32_t)(unsafe.Pointer(xc.dists))[:n:n]
 x.Dists = make([]uint32, n)
-for i, v := range cDists {
-x.Dists[i] = uint32(v)
-}
+copy(x.Dists, (*[1<<28]uint32)(unsafe.Pointer(xc.dists))[:n:n])
 }
 
  return nil}
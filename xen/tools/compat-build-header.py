@@ -2,28 +2,56 @@
 
 import re,sys
 
+# Directives hidden from the preprocessor by compat-build-source.py.
+markers = {
+ b"InClUdE": b"#include",
+ b"IfDeF": b"#ifdef",
+ b"ElSe": b"#else",
+ b"EnDif": b"#endif",
+ b"DeFiNe": b"#define",
+ b"UnDeF": b"#undef",
+}
+
+# Each entry is [ pattern, replacement, literal ], where literal is a
+# string every match contains, or None. A pattern whose literal does not
+# occur in the text can be skipped without running the regex over it.
+# Headers are handled as bytes, so nothing is decoded or re-encoded.
 pats = [
- [ r"__InClUdE__(.*)", r"#include\1" ],
- [ r"__IfDeF__ (XEN_HAVE.*)", r"#ifdef \1" ],
- [ r"__ElSe__", r"#else" ],
- [ r"__EnDif__", r"#endif" ],
- [ r"__DeFiNe__", r"#define" ],
- [ r"__UnDeF__", r"#undef" ],
- [ r"\"xen-compat.h\"", r"<public/xen-compat.h>" ],
- [ r"(struct|union|enum)\s+(xen_?)?(\w)", r"\1 compat_\3" ],
- [ r"typedef(.*)@KeeP@((xen_?)?)([\w]+)([^\w])",
-   r"typedef\1\2\4 __attribute__((__aligned__(__alignof(\1compat_\4))))\5" ],
- [ r"_t([^\w]|$)", r"_compat_t\1" ],
- [ r"int(8|16|32|64_aligned)_compat_t([^\w]|$)", r"int\1_t\2" ],
- [ r"(\su?int64(_compat)?)_T([^\w]|$)", r"\1_t\3" ],
- [ r"(^|[^\w])xen_?(\w*)_compat_t([^\w]|$$)", r"\1compat_\2_t\3" ],
- [ r"(^|[^\w])XEN_?", r"\1COMPAT_" ],
- [ r"(^|[^\w])Xen_?", r"\1Compat_" ],
- [ r"(^|[^\w])COMPAT_HANDLE_64\(", r"\1XEN_GUEST_HANDLE_64(" ],
- [ r"(^|[^\w])long([^\w]|$$)", r"\1int\2" ]
+ [ br"__(InClUdE|IfDeF(?=__ XEN_HAVE)|ElSe|EnDif|DeFiNe|UnDeF)__",
+   lambda m: markers[m.group(1)], b"__" ],
+ [ br"\"xen-compat.h\"", br"<public/xen-compat.h>", b"\"xen-compat.h\"" ],
+ [ br"(struct|union|enum)[^\S\n]+(xen_?)?(\w)", br"\1 compat_\3", None ],
+ [ br"typedef(.*)@KeeP@((xen_?)?)([\w]+)([^\w]|$)",
+   br"typedef\1\2\4 __attribute__((__aligned__(__alignof(\1compat_\4))))\5",
+   b"@KeeP@" ],
+ [ br"_t([^\w]|$)", br"_compat_t\1", b"_t" ],
+ [ br"int(8|16|32|64_aligned)_compat_t([^\w]|$)", br"int\1_t\2", b"_compat_t" ],
+ [ br"([^\S\n]u?int64(_compat)?)_T([^\w]|$)", br"\1_t\3", b"_T" ],
+ [ br"\bxen_?(\w*)_compat_t\b", br"compat_\1_t", b"xen" ],
+ [ br"\bXEN_?", br"COMPAT_", b"XEN" ],
+ [ br"\bXen_?", br"Compat_", b"Xen" ],
+ [ br"\bCOMPAT_HANDLE_64\(", br"XEN_GUEST_HANDLE_64(",
+   b"COMPAT_HANDLE_64(" ],
+ [ br"\blong\b", br"int", b"long" ]
 ];
 
-for line in sys.stdin.readlines():
-    for pat in pats:
-        line = re.subn(pat[0], pat[1], line)[0]
-    print(line.rstrip())
+# The whole input is rewritten at once, so ^ and $ have to match at
+# each line boundary, and no pattern may match across a newline.
+for pat in pats:
+    pat[0] = re.compile(pat[0], re.M)
+
+trailing_space = re.compile(br"[^\S\n]+$", re.M)
+
+# Python 3 exposes the underlying binary streams as .buffer.
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+data = stdin.read()
+if data and not data.endswith(b"\n"):
+    data += b"\n"
+
+data = trailing_space.sub(b"", data)
+for pat in pats:
+    if pat[2] is None or pat[2] in data:
+        data = pat[0].sub(pat[1], data)
+stdout.write(data)